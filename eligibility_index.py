@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""
+eligibility_index.py
+
+Matches a household (annual income + size) to every building / unit type it
+qualifies for, using the intervals published by joins_rent.sql in
+building_eligibility_interval (one row per building, bedroom bucket and
+affordability band).
+
+A band is a match when
+    min_household <= household size <= max_household
+    min_income    <= annual income  <= max_income
+where max_income is the band's LL44 income limit and min_income is only an
+affordability estimate: what the band's cheapest rent costs at the chosen
+rent burden. One static interval tree per household size answers a lookup
+in O(log n + k) instead of scanning every unit row.
+"""
+
+import pandas as pd
+
+
+class IntervalTree:
+    """Static centered interval tree over closed intervals [low, high]."""
+
+    def __init__(self, lows, highs):
+        self._lows = list(lows)
+        self._highs = list(highs)
+        self._root = self._build(list(range(len(self._lows))))
+
+    def _build(self, ids):
+        if not ids:
+            return None
+        endpoints = sorted([self._lows[i] for i in ids] + [self._highs[i] for i in ids])
+        center = endpoints[len(endpoints) // 2]
+
+        left, right, here = [], [], []
+        for i in ids:
+            if self._highs[i] < center:
+                left.append(i)
+            elif self._lows[i] > center:
+                right.append(i)
+            else:
+                here.append(i)
+
+        return (
+            center,
+            sorted(here, key=lambda i: self._lows[i]),                    # by low, asc
+            sorted(here, key=lambda i: self._highs[i], reverse=True),     # by high, desc
+            self._build(left),
+            self._build(right),
+        )
+
+    def stab(self, x):
+        """Positions of all intervals containing x."""
+        out = []
+        node = self._root
+        while node is not None:
+            center, by_low, by_high, left, right = node
+            if x < center:
+                for i in by_low:
+                    if self._lows[i] > x:
+                        break
+                    out.append(i)
+                node = left
+            elif x > center:
+                for i in by_high:
+                    if self._highs[i] < x:
+                        break
+                    out.append(i)
+                node = right
+            else:
+                out.extend(by_low)
+                break
+        return out
+
+
+class EligibilityIndex:
+    def __init__(self, intervals: pd.DataFrame, rent_burden: float):
+        """
+        intervals: rows of building_eligibility_interval (min_rent, max_income,
+        min_household, max_household, ...). rent_burden is a fraction, e.g. 0.3.
+        """
+        df = intervals.copy()
+        df["min_income"] = df["min_rent"] * 12 / rent_burden
+        df = df[df["min_income"] <= df["max_income"]].reset_index(drop=True)
+        self._df = df
+
+        self._positions = {}
+        self._trees = {}
+        if df.empty:
+            return
+        for size in range(1, int(df["max_household"].max()) + 1):
+            rows = df[(df["min_household"] <= size) & (df["max_household"] >= size)]
+            self._positions[size] = rows.index.to_numpy()
+            self._trees[size] = IntervalTree(rows["min_income"], rows["max_income"])
+
+    def match(self, annual_income: float, household_size: int) -> pd.DataFrame:
+        """
+        One row per matching building + bedroom bucket: of the bands that
+        match, the one with the cheapest rent.
+        """
+        tree = self._trees.get(household_size)
+        if tree is None:
+            return self._df.iloc[0:0]
+        hits = self._positions[household_size][tree.stab(annual_income)]
+        return (
+            self._df.iloc[hits]
+            .sort_values("min_rent", kind="stable")
+            .drop_duplicates(subset=["building_id", "bedroom_bucket"])
+            .sort_index()
+        )
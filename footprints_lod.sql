@@ -0,0 +1,73 @@
+BEGIN;
+
+------------------------------------------------------------
+-- Building footprints at several levels of detail (LOD)
+--   run after joins_rent.sql (needs building_map_fact)
+--
+--   lod | tolerance (ft, EPSG:2263) | grid (deg, WGS84) | used at zoom
+--   ----+---------------------------+-------------------+-------------
+--    0  |  1                        | 0.000001          | >= 16
+--    1  |  5                        | 0.00001           | 14 - 16
+--    2  | 25                        | 0.00005           | < 14
+--
+--   !!! keep FOOTPRINT_LODS in streamlit_app_cloud.py in sync !!!
+------------------------------------------------------------
+
+DROP TABLE IF EXISTS building_footprint_lod;
+
+CREATE TABLE building_footprint_lod AS
+WITH lod_levels (lod, tolerance_ft, grid_deg) AS (
+    VALUES
+        (0,  1.0, 0.000001),
+        (1,  5.0, 0.00001),
+        (2, 25.0, 0.00005)
+),
+simplified AS (
+    -- simplify in feet, then transform and snap (quantize) to the LOD grid
+    SELECT
+        m.building_id,
+        l.lod,
+        ST_SnapToGrid(
+            ST_Transform(
+                ST_SimplifyPreserveTopology(ST_SetSRID(m.geom, 2263), l.tolerance_ft),
+                4326
+            ),
+            l.grid_deg
+        ) AS geom_wgs84
+    FROM building_map_fact m
+    CROSS JOIN lod_levels l
+    WHERE m.geom IS NOT NULL
+),
+dumped AS (
+    -- one row per polygon part; snapping may collapse tiny parts to lines
+    SELECT
+        building_id,
+        lod,
+        ST_Dump(geom_wgs84) AS d
+    FROM simplified
+)
+SELECT
+    building_id,
+    lod::smallint               AS lod,
+    COALESCE((d).path[1], 1)    AS part,
+    (d).geom                    AS footprint
+FROM dumped
+WHERE ST_GeometryType((d).geom) = 'ST_Polygon'
+  AND NOT ST_IsEmpty((d).geom);
+
+CREATE INDEX building_footprint_lod_building_idx
+    ON building_footprint_lod (building_id);
+
+-- one spatial index per LOD, so a viewport query only scans its own level
+CREATE INDEX building_footprint_lod0_gix
+    ON building_footprint_lod USING GIST (footprint) WHERE lod = 0;
+
+CREATE INDEX building_footprint_lod1_gix
+    ON building_footprint_lod USING GIST (footprint) WHERE lod = 1;
+
+CREATE INDEX building_footprint_lod2_gix
+    ON building_footprint_lod USING GIST (footprint) WHERE lod = 2;
+
+ANALYZE building_footprint_lod;
+
+COMMIT;
@@ -167,4 +167,86 @@ GROUP BY
 CREATE INDEX IF NOT EXISTS building_map_fact_geom_gix
     ON building_map_fact USING GIST (geom);
 
+
+------------------------------------------------------------
+-- 5. Income-eligibility intervals (household matching)
+--    one row per building + bedroom bucket + affordability band, so that
+--    each row's rents and income limit come from the same band:
+--      household size range  at least 1 person per bedroom (1 in a studio),
+--                            at most 2 per bedroom + 1 (2 in a studio)
+--      max income            the band's max allowable income
+--      rent range            min / max rent within the band
+--    LL44 publishes no income floor; the app estimates one from min_rent
+--    and the user's rent burden.
+------------------------------------------------------------
+
+DROP TABLE IF EXISTS building_eligibility_interval;
+
+CREATE TABLE building_eligibility_interval AS
+WITH unit_rows AS (
+    SELECT
+        building_id_bbl AS building_id,
+        CASE
+            WHEN bedroomsize ILIKE 'STUDIO%' OR bedroomsize ILIKE '0-BR%' THEN '0br'
+            WHEN bedroomsize ILIKE '1-BR%'                                    THEN '1br'
+            WHEN bedroomsize ILIKE '2-BR%'                                    THEN '2br'
+            WHEN bedroomsize ILIKE '3-BR%'                                    THEN '3br'
+            WHEN bedroomsize ILIKE '4-BR%'                                    THEN '4br'
+            WHEN bedroomsize ILIKE '5-BR%' OR bedroomsize ILIKE '6-BR%'       THEN '5plus'
+            ELSE 'all'
+        END AS bedroom_bucket,
+        affordabilityband AS affordability_band,
+        CASE
+            WHEN totalunits ~ '^[0-9]+(\.[0-9]+)?$'
+            THEN totalunits::numeric
+            ELSE 0
+        END AS units,
+        CASE
+            WHEN maxallowableincome ~ '^[0-9]+(\.[0-9]+)?$'
+            THEN maxallowableincome::numeric
+            ELSE NULL
+        END AS max_income,
+        CASE
+            WHEN medianactualrent ~ '^[0-9]+(\.[0-9]+)?$'
+            THEN medianactualrent::numeric
+            ELSE NULL
+        END AS rent
+    FROM ll44_unit_income_rent_raw
+    WHERE building_id_bbl IS NOT NULL
+),
+occupancy (bedroom_bucket, min_household, max_household) AS (
+    VALUES
+        ('0br',   1,  2),
+        ('1br',   1,  3),
+        ('2br',   2,  5),
+        ('3br',   3,  7),
+        ('4br',   4,  9),
+        ('5plus', 5, 11),
+        ('all',   1, 11)
+)
+SELECT
+    u.building_id,
+    u.bedroom_bucket,
+    u.affordability_band,
+    o.min_household,
+    o.max_household,
+    MAX(u.max_income)              AS max_income,
+    MIN(u.rent)                    AS min_rent,
+    MAX(u.rent)                    AS max_rent,
+    SUM(u.units)                   AS units
+FROM unit_rows u
+JOIN occupancy o
+    ON o.bedroom_bucket = u.bedroom_bucket
+WHERE u.max_income IS NOT NULL
+  AND u.rent > 0
+GROUP BY
+    u.building_id,
+    u.bedroom_bucket,
+    u.affordability_band,
+    o.min_household,
+    o.max_household;
+
+CREATE INDEX IF NOT EXISTS building_eligibility_interval_building_idx
+    ON building_eligibility_interval (building_id);
+
 COMMIT;
\ No newline at end of file
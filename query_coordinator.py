@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+"""
+query_coordinator.py
+
+Keeps the database working only on a session's latest input.
+
+Queries are grouped in channels ("filters" for the main fan-out, plus one per
+tab that queries on its own, e.g. footprints for the map viewport). Each
+channel has one current Ticket, tied to a key such as the filter set. Asking
+for a ticket with a different key supersedes the channel's old ticket; asking
+with the same key returns the current one, so reruns that do not change the
+input (tab switch, map style, ...) never cancel anything. A filter change
+supersedes every channel.
+
+For a superseded ticket
+  * queries still inside the debounce window give up before they check out
+    a connection, and
+  * queries already running are cancelled on the server through the
+    connection's cancel request (same effect as pg_cancel_backend).
+
+Either way they raise QuerySuperseded.
+"""
+
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+
+
+class QuerySuperseded(Exception):
+    """The input this query was started for is no longer current."""
+
+
+class Ticket:
+    def __init__(self, coordinator: "QueryCoordinator", channel: str, key):
+        self.coordinator = coordinator
+        self.channel = channel
+        self.key = key
+        self.created_at = time.monotonic()
+
+    @property
+    def superseded(self) -> bool:
+        return self.coordinator._channels.get(self.channel) is not self
+
+    def run(self, func, *args):
+        """Runs func(*args) with this ticket as the thread's current ticket."""
+        _local.ticket = self
+        try:
+            return func(*args)
+        finally:
+            _local.ticket = None
+
+    def debounce(self) -> None:
+        """
+        Waits out the rest of the debounce window. Call before checking out a
+        connection; raises QuerySuperseded if newer input arrived meanwhile.
+        """
+        remaining = self.created_at + self.coordinator.debounce_seconds - time.monotonic()
+        if remaining > 0:
+            time.sleep(remaining)
+        if self.superseded:
+            raise QuerySuperseded()
+
+    @contextmanager
+    def track(self, dbapi_connection):
+        """Keeps dbapi_connection cancellable while one query runs on it."""
+        if not self.coordinator._register(self, dbapi_connection):
+            raise QuerySuperseded()
+        try:
+            yield
+        except Exception as e:
+            if self.superseded:
+                raise QuerySuperseded() from e
+            raise
+        finally:
+            self.coordinator._unregister(self, dbapi_connection)
+
+
+class QueryCoordinator:
+    """One per browser session (kept in st.session_state)."""
+
+    def __init__(self, debounce_seconds: float = 0.3):
+        self.debounce_seconds = debounce_seconds
+        self._lock = threading.Lock()
+        self._channels = {}    # channel -> current Ticket
+        self._running = {}     # Ticket -> set of dbapi connections
+        self._cancelling = {}  # dbapi connection -> Event set once cancelled
+
+    def ticket(self, key, channel: str = "filters", supersede_all: bool = False) -> Ticket:
+        """
+        Current ticket of channel if its key is unchanged, else a new one that
+        supersedes it (and, with supersede_all, every other channel too).
+        """
+        with self._lock:
+            current = self._channels.get(channel)
+            if current is not None and current.key == key:
+                return current
+
+            stale = list(self._channels.values()) if supersede_all else [current]
+            if supersede_all:
+                self._channels.clear()
+            # cancelled below, outside the lock: each cancel is a round trip to
+            # the server. Until then a query that ends meanwhile keeps its
+            # connection (see _unregister), so the cancel cannot hit another
+            # query that checked the same connection out of the pool.
+            to_cancel = {}
+            for old in stale:
+                for conn in self._running.pop(old, ()):
+                    to_cancel[conn] = self._cancelling[conn] = threading.Event()
+
+            ticket = Ticket(self, channel, key)
+            self._channels[channel] = ticket
+
+        for conn, done in to_cancel.items():
+            try:
+                conn.cancel()
+            except Exception as e:
+                logger.warning("could not cancel superseded query: %s", e)
+            finally:
+                with self._lock:
+                    del self._cancelling[conn]
+                done.set()
+        return ticket
+
+    def _register(self, ticket: Ticket, conn) -> bool:
+        with self._lock:
+            if ticket.superseded:
+                return False
+            self._running.setdefault(ticket, set()).add(conn)
+            return True
+
+    def _unregister(self, ticket: Ticket, conn) -> None:
+        with self._lock:
+            conns = self._running.get(ticket)
+            if conns is not None:
+                conns.discard(conn)
+                if not conns:
+                    del self._running[ticket]
+            cancelling = self._cancelling.get(conn)
+        # hold on to the connection until a pending cancel request is through
+        if cancelling is not None:
+            cancelling.wait()
+
+
+def current_ticket():
+    """The Ticket the current worker thread is running for, if any."""
+    return getattr(_local, "ticket", None)
@@ -0,0 +1,322 @@
+# -*- coding: utf-8 -*-
+"""
+shared_cache.py
+
+Query result cache shared by every Streamlit replica.
+
+st.cache_data only lives inside one process, so each replica behind a load
+balancer would otherwise repeat the same Neon queries. Results are stored as
+zstd-compressed Arrow IPC blobs, keyed by the normalized query + parameters
+and the pipeline version, in one of two backends:
+
+    DiskCache   a directory; point it at /dev/shm for a shared-memory cache
+                on a single host, or a shared volume for several hosts
+    RedisCache  any server speaking the Redis protocol (redis, valkey, or a
+                local stand-in such as fakeredis for testing)
+
+A per-key lock makes concurrent misses run the query only once; the other
+callers wait for the value the lock holder writes.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import struct
+import time
+import uuid
+
+import pandas as pd
+import pyarrow as pa
+
+try:
+    import fcntl
+except ImportError:  # not on Windows; only needed for DiskCache
+    fcntl = None
+
+try:
+    import redis
+except ImportError:  # only needed for RedisCache
+    redis = None
+
+KEY_PREFIX = "urbanlab"
+
+logger = logging.getLogger(__name__)
+
+
+# -----------------------------
+# keys and serialization
+# -----------------------------
+def make_key(query: str, params: dict, version: str) -> str:
+    """Stable key for a query; whitespace in the SQL is normalized away."""
+    payload = json.dumps(
+        [version, " ".join(query.split()), params],
+        sort_keys=True,
+        default=str,
+    )
+    return f"{KEY_PREFIX}:{version}:{hashlib.sha256(payload.encode('utf-8')).hexdigest()}"
+
+
+def frame_to_blob(df: pd.DataFrame) -> bytes:
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    sink = pa.BufferOutputStream()
+    options = pa.ipc.IpcWriteOptions(compression="zstd")
+    with pa.ipc.new_stream(sink, table.schema, options=options) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+def blob_to_frame(blob: bytes) -> pd.DataFrame:
+    return pa.ipc.open_stream(blob).read_all().to_pandas()
+
+
+# -----------------------------
+# backends
+# -----------------------------
+class DiskCache:
+    """
+    One file per key: 8-byte expiry timestamp followed by the blob. Locks are
+    flock()s on a .lock file per key.
+    """
+
+    def __init__(self, directory: str, sweep_interval: int = 300):
+        if fcntl is None:
+            raise ImportError("DiskCache needs fcntl (Linux or macOS); use RedisCache instead")
+        self.directory = directory
+        self.sweep_interval = sweep_interval
+        self._last_sweep = 0.0
+        self._lock_fds = {}  # token -> fd holding the flock
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key: str, suffix: str) -> str:
+        return os.path.join(self.directory, key.replace(":", "_") + suffix)
+
+    @staticmethod
+    def _remove(path: str) -> None:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def get(self, key: str):
+        path = self._path(key, ".arrow")
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        (expires_at,) = struct.unpack("!d", data[:8])
+        if expires_at < time.time():
+            self._remove(path)
+            return None
+        return data[8:]
+
+    def set(self, key: str, blob: bytes, ttl: int) -> None:
+        # write to a temp file and rename, so readers never see half a blob
+        path = self._path(key, ".arrow")
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(struct.pack("!d", time.time() + ttl))
+            f.write(blob)
+        os.replace(tmp_path, path)
+
+        if time.time() - self._last_sweep > self.sweep_interval:
+            self.sweep()
+
+    def sweep(self) -> None:
+        """
+        Deletes expired entries, and temp files of writers that died. Keys
+        that are never read again (old rent values, old map viewports) would
+        otherwise stay on disk, or in memory under /dev/shm, forever.
+        """
+        self._last_sweep = now = time.time()
+        for entry in os.scandir(self.directory):
+            try:
+                if entry.name.endswith(".arrow"):
+                    with open(entry.path, "rb") as f:
+                        (expires_at,) = struct.unpack("!d", f.read(8))
+                    if expires_at < now:
+                        self._remove(entry.path)
+                elif entry.name.endswith(".tmp"):
+                    if entry.stat().st_mtime + self.sweep_interval < now:
+                        self._remove(entry.path)
+            except (OSError, struct.error):
+                continue
+
+    def acquire_lock(self, key: str, ttl: int):
+        """
+        Returns a token for release_lock, or None if the lock is taken.
+
+        Taking an flock() is atomic, and the kernel drops it when its holder
+        dies, so there is no stale lock to take over (ttl is unused here).
+        """
+        path = self._path(key, ".lock")
+        while True:
+            fd = os.open(path, os.O_CREAT | os.O_RDWR)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(fd)
+                return None
+            # the previous holder unlinks the file on release; if that happened
+            # after our open, we locked a file nobody else will see, so retry
+            try:
+                if os.stat(path).st_ino == os.fstat(fd).st_ino:
+                    break
+            except FileNotFoundError:
+                pass
+            os.close(fd)
+
+        token = uuid.uuid4().hex
+        self._lock_fds[token] = fd
+        return token
+
+    def release_lock(self, key: str, token: str) -> None:
+        fd = self._lock_fds.pop(token, None)
+        if fd is None:
+            return
+        # unlink while still holding the lock, so the file at path is always
+        # the one whose flock counts (see acquire_lock)
+        self._remove(self._path(key, ".lock"))
+        os.close(fd)
+
+
+class RedisCache:
+    """Values via SET EX, locks via SET NX PX with a per-holder token."""
+
+    def __init__(self, client):
+        self.client = client
+
+    @classmethod
+    def from_url(cls, url: str) -> "RedisCache":
+        if redis is None:
+            raise ImportError("RedisCache needs the 'redis' package: pip install redis")
+        return cls(redis.Redis.from_url(url))
+
+    def get(self, key: str):
+        return self.client.get(key)
+
+    def set(self, key: str, blob: bytes, ttl: int) -> None:
+        self.client.set(key, blob, ex=ttl)
+
+    def acquire_lock(self, key: str, ttl: int):
+        """Returns a token for release_lock, or None if the lock is taken."""
+        token = uuid.uuid4().hex
+        if self.client.set(f"{key}:lock", token, nx=True, px=ttl * 1000):
+            return token
+        return None
+
+    def release_lock(self, key: str, token: str) -> None:
+        # only delete the lock if it is still ours (it may have expired and
+        # been taken by another holder in the meantime)
+        lock_key = f"{key}:lock"
+        with self.client.pipeline() as pipe:
+            try:
+                pipe.watch(lock_key)
+                current = pipe.get(lock_key)
+                if current is not None and current.decode("utf-8") == token:
+                    pipe.multi()
+                    pipe.delete(lock_key)
+                    pipe.execute()
+            except redis.WatchError:
+                pass
+
+
+# -----------------------------
+# cache front-end
+# -----------------------------
+class SharedResultCache:
+    def __init__(self, backend, version: str, ttl: int = 3600,
+                 lock_ttl: int = 60, poll_interval: float = 0.1):
+        self.backend = backend
+        self.version = str(version)
+        self.ttl = ttl
+        self.lock_ttl = lock_ttl
+        self.poll_interval = poll_interval
+
+    def _get(self, key: str):
+        blob = self.backend.get(key)
+        return None if blob is None else blob_to_frame(blob)
+
+    def get_or_compute(self, query: str, params: dict, compute,
+                       should_abort=None) -> pd.DataFrame:
+        """
+        Returns the cached frame for (query, params), or runs compute() once
+        across all replicas and stores its result.
+
+        should_abort() is checked while waiting for another caller's result;
+        once it returns True, waiting stops and compute() is called right away
+        (for a superseded query, compute() raises instead of querying).
+
+        Backend failures never reach the caller: the query then simply runs
+        (or its result is returned) uncached.
+        """
+        key = make_key(query, params, self.version)
+        try:
+            df = self._get(key)
+        except Exception as e:
+            logger.warning("shared cache unavailable, querying directly: %s", e)
+            return compute()
+        if df is not None:
+            return df
+
+        deadline = time.monotonic() + self.lock_ttl
+        while time.monotonic() < deadline:
+            try:
+                token = self.backend.acquire_lock(key, self.lock_ttl)
+            except Exception as e:
+                logger.warning("shared cache lock failed, querying directly: %s", e)
+                return compute()
+
+            if token is not None:
+                return self._compute_locked(key, token, compute)
+
+            time.sleep(self.poll_interval)
+            if should_abort is not None and should_abort():
+                return compute()
+            try:
+                df = self._get(key)
+            except Exception as e:
+                logger.warning("shared cache unavailable, querying directly: %s", e)
+                return compute()
+            if df is not None:
+                return df
+
+        # the lock holder is stuck; don't keep the user waiting any longer
+        return compute()
+
+    def _compute_locked(self, key: str, token: str, compute) -> pd.DataFrame:
+        try:
+            # another caller may have filled it between get and lock
+            try:
+                df = self._get(key)
+            except Exception as e:
+                logger.warning("shared cache read failed: %s", e)
+                df = None
+            if df is not None:
+                return df
+
+            df = compute()
+            try:
+                self.backend.set(key, frame_to_blob(df), self.ttl)
+            except Exception as e:
+                logger.warning("shared cache write failed: %s", e)
+            return df
+        finally:
+            try:
+                self.backend.release_lock(key, token)
+            except Exception as e:
+                logger.warning("shared cache lock release failed: %s", e)
+
+
+def from_url(url: str, version: str, ttl: int = 3600) -> SharedResultCache:
+    """
+    redis://host:6379/0, rediss://... -> RedisCache
+    file:///dev/shm/urbanlab or a plain path -> DiskCache
+    """
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        backend = RedisCache.from_url(url)
+    else:
+        directory = url[len("file://"):] if url.startswith("file://") else url
+        backend = DiskCache(directory)
+    return SharedResultCache(backend, version=version, ttl=ttl)
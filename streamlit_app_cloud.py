@@ -9,12 +9,19 @@ Created on Thu Nov 13 03:48:41 2025
 # Features: Text Input Rent Filter, Zip Code Analytics, Price by Unit Type
 
 import os
+import json
+import math
 import pandas as pd
 import streamlit as st
 import pydeck as pdk
 import altair as alt
-import re
+from concurrent.futures import ThreadPoolExecutor, wait
 from sqlalchemy import create_engine, text
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+
+import shared_cache
+from eligibility_index import EligibilityIndex
+from query_coordinator import QueryCoordinator, QuerySuperseded, current_ticket
 
 # -----------------------------------------------------------------------------
 # 1. App Configuration
@@ -41,104 +48,448 @@ except Exception as e:
     st.error(f"详细错误: {e}")
     st.stop()
 
+
+# -----------------------------------------------------------------------------
+# 2b. Connection Pool
 # -----------------------------------------------------------------------------
-# 3. Helper Functions (Updated to parse Rent)
+# One pooled engine per process. The query fan-out in section 4b borrows up to
+# DB_POOL_SIZE connections from it at the same time.
+DB_POOL_SIZE = 4
+# Server-side cap for any single dashboard query (milliseconds)
+QUERY_TIMEOUT_MS = int(st.secrets.get("QUERY_TIMEOUT_MS", 15000))
+
+@st.cache_resource
+def get_engine():
+    return create_engine(
+        f"postgresql+psycopg2://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}",
+        pool_size=DB_POOL_SIZE,
+        max_overflow=2,
+        pool_pre_ping=True,
+    )
+
+# -----------------------------------------------------------------------------
+# 2c. Shared Result Cache (optional)
+# -----------------------------------------------------------------------------
+# st.cache_data is per process. With several replicas, set RESULT_CACHE_URL
+# (redis://host:6379/0, or a directory such as /dev/shm/urbanlab) so query
+# results are shared. Bump PIPELINE_VERSION after re-running the SQL pipeline.
+@st.cache_resource
+def get_shared_cache():
+    url = st.secrets.get("RESULT_CACHE_URL")
+    if not url:
+        return None
+    return shared_cache.from_url(
+        url,
+        version=st.secrets.get("PIPELINE_VERSION", "1"),
+        ttl=int(st.secrets.get("RESULT_CACHE_TTL", 3600)),
+    )
+
 # -----------------------------------------------------------------------------
-def parse_bedroom_data(df):
+# 3. Helper Functions
+# -----------------------------------------------------------------------------
+# filter_key = (boroughs, min_rent, max_rent, min_units, zipcode), all hashable.
+def make_filter_key(boroughs, min_rent, max_rent, min_units, target_zipcode):
+    return (
+        tuple(sorted(boroughs)),
+        int(min_rent),
+        int(max_rent),
+        int(min_units),
+        (target_zipcode or "").strip(),
+    )
+
+def build_filter_clause(filter_key):
     """
-    Parses 'bedroom_rent_summary' to extract unit counts AND rent by type.
-    Example string: "0br | units: 5 | rent: 1000; 1br | units: 10 | rent: 1500"
+    WHERE clause on building_map_fact shared by every query below,
+    so KPIs, map, charts and table all describe the same buildings.
     """
-    parsed_rows = []
-    for _, row in df.iterrows():
-        summary = row.get('bedroom_rent_summary', '')
-        if not summary or pd.isna(summary):
-            continue
-            
-        parts = summary.split(';')
-        for part in parts:
-            # Regex to extract type, count, AND optional rent
-            # Pattern looks for: "TYPE | units: NUM" and optionally "| rent: NUM"
-            match = re.search(r'([a-zA-Z0-9-]+)\s*\|\s*units:\s*(\d+)(?:\s*\|\s*rent:\s*(\d+))?', part)
-            if match:
-                unit_type = match.group(1).upper() # e.g., "1BR"
-                count = int(match.group(2))
-                rent_str = match.group(3)
-                rent_val = int(rent_str) if rent_str else None
-                
-                parsed_rows.append({
-                    'Borough': row['borough'],
-                    'Unit Type': unit_type,
-                    'Count': count,
-                    'Est Rent': rent_val
-                })
-    
-    if not parsed_rows:
-        return pd.DataFrame(columns=['Borough', 'Unit Type', 'Count', 'Est Rent'])
-        
-    return pd.DataFrame(parsed_rows)
+    boroughs, min_rent, max_rent, min_units, zipcode = filter_key
+    sql = """
+        min_effective_median_rent BETWEEN :min_rent AND :max_rent
+        AND total_ll44_units >= :min_units
+        AND min_effective_median_rent > 0
+        AND geom IS NOT NULL
+    """
+    params = {
+        "min_rent": min_rent,
+        "max_rent": max_rent,
+        "min_units": min_units
+    }
+
+    if boroughs:
+        sql += " AND borough = ANY(:boroughs)"
+        params["boroughs"] = list(boroughs)
+
+    if zipcode:
+        sql += " AND zipcode = :zipcode"
+        params["zipcode"] = zipcode
+
+    return sql, params
+
+def run_query(sql, params) -> pd.DataFrame:
+    # coordinated queries: debounced before a connection is checked out,
+    # and cancelled on the server once newer input arrives
+    ticket = current_ticket()
+
+    def fetch():
+        if ticket is not None:
+            ticket.debounce()
+
+        # SET LOCAL (not a connect option) so it also works behind Neon's pooler
+        with get_engine().begin() as conn:
+            conn.exec_driver_sql(f"SET LOCAL statement_timeout = {QUERY_TIMEOUT_MS}")
+            if ticket is None:
+                return pd.read_sql(text(sql), conn, params=params)
+            with ticket.track(conn.connection.dbapi_connection):
+                return pd.read_sql(text(sql), conn, params=params)
+
+    # sql + params are built from the normalized filter_key, so they make a
+    # stable key for the shared cache
+    cache = get_shared_cache()
+    if cache is None:
+        return fetch()
+    # stop waiting on another replica's result once the input has moved on
+    should_abort = None if ticket is None else (lambda: ticket.superseded)
+    return cache.get_or_compute(sql, params, fetch, should_abort=should_abort)
+
+# Levels published by footprints_lod.sql as (lod, min_zoom), finest first.
+FOOTPRINT_LODS = [(0, 16), (1, 14), (2, 0)]
+
+def choose_lod(zoom):
+    for lod, min_zoom in FOOTPRINT_LODS:
+        if zoom >= min_zoom:
+            return lod
+    return FOOTPRINT_LODS[-1][0]
+
+def viewport_bbox(lat, lon, zoom, width_px=1200, height_px=500):
+    """
+    Approximate (west, south, east, north) visible for a deck.gl view state
+    (web mercator, 512px world at zoom 0). Rounded so nearby views share
+    a cache entry.
+    """
+    deg_per_px = 360.0 / (512 * 2 ** zoom)
+    half_w = width_px / 2 * deg_per_px
+    half_h = height_px / 2 * deg_per_px * math.cos(math.radians(lat))
+    return (
+        round(lon - half_w, 4),
+        round(lat - half_h, 4),
+        round(lon + half_w, 4),
+        round(lat + half_h, 4),
+    )
 
 # -----------------------------------------------------------------------------
-# 4. Data Loading
+# 4. Data Loading (narrow, purpose-built queries)
 # -----------------------------------------------------------------------------
-@st.cache_data(show_spinner="Querying database...")
-def load_filtered_data(boroughs, min_rent, max_rent, min_units, target_zipcode=None) -> pd.DataFrame:
-    try:
-        engine = create_engine(
-            f"postgresql+psycopg2://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
-        )
-        
-        sql = """
-            WITH transformed AS (
-                SELECT
-                    *,
-                    ST_Transform(ST_SetSRID(ST_Centroid(geom), 2263), 4326) AS geom_wgs84
-                FROM building_map_fact
-            )
+# These run on worker threads (section 4b), so they never call st.* and
+# let errors propagate to the caller instead of rendering them.
+@st.cache_data(show_spinner=False)
+def query_kpis(filter_key) -> dict:
+    where, params = build_filter_clause(filter_key)
+    df = run_query(f"""
+        SELECT
+            COUNT(*)                                    AS n_buildings,
+            COALESCE(SUM(total_ll44_units), 0)::bigint  AS total_units,
+            AVG(min_effective_median_rent)::float8      AS avg_rent,
+            MIN(min_effective_median_rent)::float8      AS min_rent
+        FROM building_map_fact
+        WHERE {where};
+    """, params)
+    return df.iloc[0].to_dict()
+
+@st.cache_data(show_spinner=False)
+def query_map_points(filter_key, max_points, with_summary) -> pd.DataFrame:
+    """
+    Slim map columns only. The sample is deterministic (hash of building_id)
+    and is taken in the database, so at most max_points rows are sent.
+    """
+    where, params = build_filter_clause(filter_key)
+    params["max_points"] = max_points
+    summary_col = ", bedroom_rent_summary" if with_summary else ""
+    df = run_query(f"""
+        WITH sampled AS (
             SELECT
                 building_id,
                 borough,
                 address,
-                zipcode,
-                ST_X(geom_wgs84) AS lon,
-                ST_Y(geom_wgs84) AS lat,
+                geom,
                 min_effective_median_rent,
-                total_ll44_units,
-                bedroom_rent_summary
-            FROM transformed
-            WHERE
-                min_effective_median_rent BETWEEN :min_rent AND :max_rent
-                AND total_ll44_units >= :min_units
-                AND min_effective_median_rent > 0 
-        """
-        
-        params = {
-            "min_rent": min_rent,
-            "max_rent": max_rent,
-            "min_units": min_units
-        }
+                total_ll44_units
+                {summary_col}
+            FROM building_map_fact
+            WHERE {where}
+            ORDER BY md5(building_id::text)
+            LIMIT :max_points
+        ),
+        transformed AS (
+            SELECT
+                *,
+                ST_Transform(ST_SetSRID(ST_Centroid(geom), 2263), 4326) AS geom_wgs84
+            FROM sampled
+        )
+        SELECT
+            building_id,
+            borough,
+            address,
+            ST_X(geom_wgs84) AS lon,
+            ST_Y(geom_wgs84) AS lat,
+            min_effective_median_rent,
+            total_ll44_units
+            {summary_col}
+        FROM transformed;
+    """, params)
+
+    df['address'] = df['address'].fillna('Unknown Address')
+    if with_summary:
+        df['bedroom_rent_summary'] = df['bedroom_rent_summary'].fillna('No details available')
+    return df.dropna(subset=["lon", "lat"])
+
+@st.cache_data(show_spinner=False)
+def query_map_center(filter_key) -> dict:
+    """Center of the filtered buildings' extent, in WGS84."""
+    where, params = build_filter_clause(filter_key)
+    df = run_query(f"""
+        WITH extent AS (
+            SELECT ST_Transform(
+                ST_SetSRID(ST_Centroid(ST_Extent(geom)::geometry), 2263), 4326
+            ) AS center
+            FROM building_map_fact
+            WHERE {where}
+        )
+        SELECT ST_X(center) AS lon, ST_Y(center) AS lat
+        FROM extent;
+    """, params)
+    return df.iloc[0].to_dict()
 
-        if boroughs:
-            sql += " AND borough = ANY(:boroughs)"
-            params["boroughs"] = list(boroughs)
-        
-        if target_zipcode and target_zipcode.strip():
-            sql += " AND zipcode = :zipcode"
-            params["zipcode"] = target_zipcode.strip()
+@st.cache_data(show_spinner=False)
+def query_footprints(filter_key, lod, bbox, max_polygons) -> pd.DataFrame:
+    """
+    Precomputed footprint polygons of one LOD inside the viewport bbox.
+    The lod is inlined so the planner can pick that level's partial GiST index.
+    """
+    where, params = build_filter_clause(filter_key)
+    params.update(zip(("west", "south", "east", "north"), bbox))
+    params["max_polygons"] = max_polygons
+    df = run_query(f"""
+        SELECT
+            f.building_id,
+            m.borough,
+            m.address,
+            m.min_effective_median_rent,
+            m.total_ll44_units,
+            ST_AsGeoJSON(f.footprint, 6) AS footprint
+        FROM building_footprint_lod f
+        JOIN building_map_fact m
+            ON m.building_id = f.building_id
+        WHERE f.lod = {int(lod)}
+          AND f.footprint && ST_MakeEnvelope(:west, :south, :east, :north, 4326)
+          AND {where}
+        ORDER BY md5(f.building_id::text)
+        LIMIT :max_polygons;
+    """, params)
+
+    df['address'] = df['address'].fillna('Unknown Address')
+    # GeoJSON Polygon -> list of rings, the shape PolygonLayer expects
+    df['footprint'] = df['footprint'].map(lambda g: json.loads(g)["coordinates"])
+    return df
+
+@st.cache_data(show_spinner=False)
+def query_unit_types(filter_key) -> pd.DataFrame:
+    """Unit counts and average rent per bedroom type, aggregated in SQL."""
+    where, params = build_filter_clause(filter_key)
+    return run_query(f"""
+        SELECT
+            UPPER(COALESCE(u.bedroom_size_raw, 'N/A'))      AS unit_type,
+            SUM(COALESCE(u.ll44_total_units, 0))            AS unit_count,
+            AVG(ROUND(u.effective_median_rent))
+                FILTER (WHERE u.effective_median_rent > 0)  AS avg_rent
+        FROM building_unit_rent_fact u
+        WHERE u.building_id IN (
+            SELECT building_id FROM building_map_fact WHERE {where}
+        )
+        GROUP BY 1;
+    """, params)
+
+@st.cache_data(show_spinner=False)
+def query_top_zipcodes(filter_key, limit=10) -> pd.DataFrame:
+    where, params = build_filter_clause(filter_key)
+    params["limit"] = limit
+    return run_query(f"""
+        SELECT zipcode, COUNT(*) AS n_buildings
+        FROM building_map_fact
+        WHERE {where}
+          AND zipcode IS NOT NULL
+        GROUP BY zipcode
+        ORDER BY n_buildings DESC
+        LIMIT :limit;
+    """, params)
+
+@st.cache_data(show_spinner=False)
+def query_rents(filter_key) -> pd.DataFrame:
+    """Single numeric column, used for the savings histogram."""
+    where, params = build_filter_clause(filter_key)
+    return run_query(f"""
+        SELECT min_effective_median_rent
+        FROM building_map_fact
+        WHERE {where};
+    """, params)
+
+@st.cache_data(show_spinner=False)
+def query_table_page(filter_key, page, page_size) -> pd.DataFrame:
+    where, params = build_filter_clause(filter_key)
+    params["limit"] = page_size
+    params["offset"] = (page - 1) * page_size
+    df = run_query(f"""
+        SELECT
+            borough,
+            address,
+            zipcode,
+            min_effective_median_rent,
+            total_ll44_units,
+            bedroom_rent_summary
+        FROM building_map_fact
+        WHERE {where}
+        ORDER BY min_effective_median_rent, building_id
+        LIMIT :limit OFFSET :offset;
+    """, params)
+
+    df['address'] = df['address'].fillna('Unknown Address')
+    df['bedroom_rent_summary'] = df['bedroom_rent_summary'].fillna('No details available')
+    return df
+
+@st.cache_data(show_spinner=False)
+def load_eligibility_intervals() -> pd.DataFrame:
+    """All building_eligibility_interval rows (small), with building details."""
+    return run_query("""
+        SELECT
+            e.building_id,
+            m.borough,
+            m.address,
+            m.zipcode,
+            e.bedroom_bucket,
+            e.affordability_band,
+            e.min_household,
+            e.max_household,
+            e.min_rent::float8      AS min_rent,
+            e.max_rent::float8      AS max_rent,
+            e.max_income::float8    AS max_income,
+            e.units::float8         AS units
+        FROM building_eligibility_interval e
+        JOIN building_map_fact m
+            ON m.building_id = e.building_id;
+    """, {})
+
+@st.cache_resource(show_spinner=False)
+def get_eligibility_index(rent_ratio_pct) -> EligibilityIndex:
+    # built once per burden setting and shared by all sessions
+    return EligibilityIndex(load_eligibility_intervals(), rent_ratio_pct / 100.0)
+
+@st.cache_data(show_spinner="Preparing export...")
+def load_filtered_data(filter_key) -> pd.DataFrame:
+    """Full building list for the CSV download; only run on request."""
+    where, params = build_filter_clause(filter_key)
+    df = run_query(f"""
+        WITH transformed AS (
+            SELECT
+                *,
+                ST_Transform(ST_SetSRID(ST_Centroid(geom), 2263), 4326) AS geom_wgs84
+            FROM building_map_fact
+            WHERE {where}
+        )
+        SELECT
+            building_id,
+            borough,
+            address,
+            zipcode,
+            ST_X(geom_wgs84) AS lon,
+            ST_Y(geom_wgs84) AS lat,
+            min_effective_median_rent,
+            total_ll44_units,
+            bedroom_rent_summary
+        FROM transformed;
+    """, params)
+
+    df['address'] = df['address'].fillna('Unknown Address')
+    df['bedroom_rent_summary'] = df['bedroom_rent_summary'].fillna('No details available')
+    return df.dropna(subset=["lon", "lat"])
+
+def add_monthly_saving(df, budget, rent_col="min_effective_median_rent"):
+    df = df.copy()
+    if budget > 0:
+        df["monthly_saving"] = budget - df[rent_col]
+    else:
+        df["monthly_saving"] = 0
+    return df
 
-        sql += ";"
+@st.cache_data(show_spinner=False)
+def get_export_csv(filter_key, budget) -> bytes:
+    df = add_monthly_saving(load_filtered_data(filter_key), budget)
+    return df.to_csv(index=False).encode('utf-8')
 
-        with engine.connect() as conn:
-            df = pd.read_sql(text(sql), conn, params=params)
+# -----------------------------------------------------------------------------
+# 4b. Query Fan-Out
+# -----------------------------------------------------------------------------
+def get_query_coordinator() -> QueryCoordinator:
+    if "query_coordinator" not in st.session_state:
+        st.session_state["query_coordinator"] = QueryCoordinator(debounce_seconds=0.3)
+    return st.session_state["query_coordinator"]
 
-        df['address'] = df['address'].fillna('Unknown Address')
-        df['bedroom_rent_summary'] = df['bedroom_rent_summary'].fillna('No details available')
-        
-        df = df.dropna(subset=["lon", "lat"])
-        return df
+def submit_queries(jobs, key, channel="filters"):
+    """
+    Starts {name: (func, args)} on a thread pool and returns {name: Future}
+    without waiting. Worker threads inherit this run's ScriptRunContext so the
+    st.cache_data wrappers work there; a later call with the same arguments on
+    the main thread waits for the in-flight result instead of re-querying.
+
+    All jobs share the session's ticket for (channel, key). A new key cancels
+    what the channel still has running for the old one; a new filter key
+    cancels every channel.
+    """
+    ticket = get_query_coordinator().ticket(key, channel, supersede_all=(channel == "filters"))
+    ctx = get_script_run_ctx()
+    pool = ThreadPoolExecutor(
+        max_workers=DB_POOL_SIZE,
+        initializer=add_script_run_ctx,
+        initargs=(None, ctx),
+    )
+    futures = {
+        name: pool.submit(ticket.run, func, *args)
+        for name, (func, args) in jobs.items()
+    }
+    pool.shutdown(wait=False)
+    return futures
+
+def wait_until_done(futures):
+    """
+    Waits for query futures in short slices. Each slice touches a placeholder,
+    which gives Streamlit the chance to stop this run when newer input arrives
+    (a bare future.result() would keep the run alive until the query ends).
+    """
+    futures = list(futures)
+    placeholder = st.empty()
+    placeholder.caption("⏳ Querying database...")
+    # every touch is a websocket message, so keep the slices coarse
+    while wait(futures, timeout=0.3).not_done:
+        placeholder.caption("⏳ Querying database...")
+    placeholder.empty()
+
+def fetch_for_tab(func, *args, channel=None):
+    """
+    Runs one of the queries above for a tab section. Failures are shown like
+    the KPI block does; the caller gets None and stops drawing the section.
+
+    Queries driven by the tab's own widgets (viewport, page, export) pass a
+    channel, so they are debounced and superseded like the filter queries.
+    """
+    try:
+        if channel is None:
+            return func(*args)
+        futures = submit_queries({"result": (func, args)}, args, channel)
+        wait_until_done(futures.values())
+        return futures["result"].result()
+    except QuerySuperseded:
+        st.stop()
     except Exception as e:
         st.error(f"Database connection error: {e}")
-        return pd.DataFrame()
+        return None
 
 # -----------------------------------------------------------------------------
 # 5. Sidebar UI
@@ -161,6 +512,11 @@ with st.sidebar:
             min_value=10, max_value=60, value=30, step=5,
             help="Recommended: < 30%"
         )
+    household_size = st.number_input(
+        "Household Size",
+        min_value=1, max_value=11, value=2, step=1,
+        help="Up to 11 people (two per bedroom plus one, 5+ bedrooms)"
+    )
 
     calculated_max_rent = 0
     if monthly_income > 0:
@@ -210,231 +566,428 @@ with st.sidebar:
     st.subheader("⚙️ Display Settings")
     max_points = st.slider("Max Map Points", 1000, 50000, 10000)
     map_style_toggle = st.radio("Map Style", ["Light", "Dark"], horizontal=True)
-    map_layer_type = st.radio("Map Mode", ["Scatter", "Heatmap"], horizontal=True)
+    map_layer_type = st.radio("Map Mode", ["Scatter", "Heatmap", "Footprints"], horizontal=True)
 
 # -----------------------------------------------------------------------------
 # 6. Data Fetching
 # -----------------------------------------------------------------------------
-if monthly_income > 0 or max_rent_input > 0:
-    df_filtered = load_filtered_data(
-        boroughs=selected_boros,
-        min_rent=min_rent_input,
-        max_rent=max_rent_input,
-        min_units=min_bldg_units,
-        target_zipcode=target_zip
-    )
+filter_key = make_filter_key(
+    boroughs=selected_boros,
+    min_rent=min_rent_input,
+    max_rent=max_rent_input,
+    min_units=min_bldg_units,
+    target_zipcode=target_zip
+)
+
+TAB_MAP = "🗺️ Map Explorer"
+TAB_ANALYTICS = "📈 Market Insights"
+TAB_ELIGIBILITY = "🎯 Eligibility"
+TAB_DATA = "📋 Details"
+ALL_TABS = [TAB_MAP, TAB_ANALYTICS, TAB_ELIGIBILITY, TAB_DATA]
+TABLE_PAGE_SIZE = 500
+
+if st.session_state.get("active_tab") not in ALL_TABS:
+    st.session_state["active_tab"] = TAB_MAP
+
+has_filters = monthly_income > 0 or max_rent_input > 0
+
+if has_filters:
+    # Fire the small KPI query together with the queries of the visible tab;
+    # the KPI cards are drawn as soon as their own result is back.
+    jobs = {"kpis": (query_kpis, (filter_key,))}
+    active_tab = st.session_state["active_tab"]
+    if active_tab == TAB_MAP and map_layer_type == "Footprints":
+        jobs["map_center"] = (query_map_center, (filter_key,))
+    elif active_tab == TAB_MAP:
+        jobs["map"] = (query_map_points, (filter_key, max_points, map_layer_type == "Scatter"))
+    elif active_tab == TAB_ANALYTICS:
+        jobs["unit_types"] = (query_unit_types, (filter_key,))
+        jobs["zipcodes"] = (query_top_zipcodes, (filter_key,))
+        jobs["rents"] = (query_rents, (filter_key,))
+    elif active_tab == TAB_ELIGIBILITY:
+        jobs["eligibility"] = (load_eligibility_intervals, ())
+    else:
+        page = st.session_state.get("table_page", 1)
+        jobs["table"] = (query_table_page, (filter_key, page, TABLE_PAGE_SIZE))
+    futures = submit_queries(jobs, filter_key)
+
+# -----------------------------------------------------------------------------
+# 7. Tab Sections
+# -----------------------------------------------------------------------------
+# Each section is a fragment: widgets inside it only rerun that section, and
+# only the section of the active tab is executed at all.
+@st.fragment
+def render_map_tab(filter_key, max_points, map_style_toggle, map_layer_type):
+    if map_layer_type == "Footprints":
+        # The chart does not report its view state back, so the viewport is
+        # driven from here and only polygons inside it are fetched.
+        center = fetch_for_tab(query_map_center, filter_key)
+        if center is None:
+            return
+        col_zoom, col_lat, col_lon = st.columns([2, 1, 1])
+        with col_zoom:
+            zoom = st.slider("Zoom", 11.0, 18.0, 15.0, step=0.5)
+        with col_lat:
+            center_lat = st.number_input("Center Lat", value=float(center["lat"]), step=0.005, format="%.4f")
+        with col_lon:
+            center_lon = st.number_input("Center Lon", value=float(center["lon"]), step=0.005, format="%.4f")
+
+        lod = choose_lod(zoom)
+        bbox = viewport_bbox(center_lat, center_lon, zoom)
+        df_plot = fetch_for_tab(query_footprints, filter_key, lod, bbox, max_points, channel="footprints")
+        if df_plot is None:
+            return
+        st.caption(f"Level of detail {lod}: {len(df_plot):,} footprints in view.")
+        if len(df_plot) >= max_points:
+            st.caption(f"Showing the first {max_points:,} footprints only; zoom in or raise Max Map Points to see every building in view.")
+
+        view_state = pdk.ViewState(
+            latitude=center_lat,
+            longitude=center_lon,
+            zoom=zoom,
+            pitch=0,
+        )
+    else:
+        df_plot = fetch_for_tab(query_map_points, filter_key, max_points, map_layer_type == "Scatter")
+        if df_plot is None:
+            return
+
+        view_state = pdk.ViewState(
+            latitude=df_plot["lat"].mean(),
+            longitude=df_plot["lon"].mean(),
+            zoom=10.5,
+            pitch=0, 
+        )
+
+    layers = []
+    tooltip = None
+
+    if map_layer_type == "Scatter":
+        scatter_layer = pdk.Layer(
+            "ScatterplotLayer",
+            data=df_plot,
+            get_position="[lon, lat]",
+            get_radius=30,
+            get_fill_color=[255, 140, 0, 180],
+            get_line_color=[255, 255, 255],
+            pickable=True,
+            auto_highlight=True,
+        )
+        layers.append(scatter_layer)
+        
+        tooltip = {
+            "html": """
+            <div style="color: white; font-family: sans-serif; width: 250px;">
+                <h4 style="margin: 0; padding-bottom: 5px; border-bottom: 1px solid #555;">{address}</h4>
+                <div style="margin-top: 5px;">
+                    <strong>Borough:</strong> {borough}<br/>
+                    <strong>Est. Rent:</strong> ${min_effective_median_rent}<br/>
+                    <strong>Units:</strong> {total_ll44_units}
+                </div>
+                <div style="margin-top: 10px; font-size: 0.8em; color: #ccc; white-space: pre-wrap;">
+                    {bedroom_rent_summary}
+                </div>
+            </div>
+            """,
+            "style": {
+                "backgroundColor": "#1f2937",
+                "borderRadius": "5px",
+                "padding": "10px",
+                "boxShadow": "0 2px 4px rgba(0,0,0,0.3)"
+            }
+        }
+    elif map_layer_type == "Footprints":
+        polygon_layer = pdk.Layer(
+            "PolygonLayer",
+            data=df_plot,
+            get_polygon="footprint",
+            get_fill_color=[255, 140, 0, 160],
+            get_line_color=[255, 255, 255],
+            line_width_min_pixels=1,
+            stroked=True,
+            pickable=True,
+            auto_highlight=True,
+        )
+        layers.append(polygon_layer)
+
+        tooltip = {
+            "html": """
+            <div style="color: white; font-family: sans-serif; width: 250px;">
+                <h4 style="margin: 0; padding-bottom: 5px; border-bottom: 1px solid #555;">{address}</h4>
+                <div style="margin-top: 5px;">
+                    <strong>Borough:</strong> {borough}<br/>
+                    <strong>Est. Rent:</strong> ${min_effective_median_rent}<br/>
+                    <strong>Units:</strong> {total_ll44_units}
+                </div>
+            </div>
+            """,
+            "style": {
+                "backgroundColor": "#1f2937",
+                "borderRadius": "5px",
+                "padding": "10px",
+                "boxShadow": "0 2px 4px rgba(0,0,0,0.3)"
+            }
+        }
+    else:
+        # Heatmap
+        heatmap_layer = pdk.Layer(
+            "HeatmapLayer",
+            data=df_plot,
+            get_position="[lon, lat]",
+            opacity=0.9,
+            get_weight="total_ll44_units",
+            radius_pixels=50,
+        )
+        layers.append(heatmap_layer)
+
+    map_style = "mapbox://styles/mapbox/dark-v10" if map_style_toggle == "Dark" else "mapbox://styles/mapbox/light-v9"
+
+    st.pydeck_chart(pdk.Deck(
+        map_style=map_style,
+        initial_view_state=view_state,
+        layers=layers,
+        tooltip=tooltip,
+    ), use_container_width=True)
+
+@st.fragment
+def render_analytics_tab(filter_key, budget):
+    unit_df = fetch_for_tab(query_unit_types, filter_key)
+    zip_counts = fetch_for_tab(query_top_zipcodes, filter_key)
+    rents_df = fetch_for_tab(query_rents, filter_key)
+    if unit_df is None or zip_counts is None or rents_df is None:
+        return
+
+    col_a, col_b = st.columns(2)
     
-    if not df_filtered.empty:
-        if calculated_max_rent > 0:
-            df_filtered["monthly_saving"] = calculated_max_rent - df_filtered["min_effective_median_rent"]
+    # 1. Unit Type Counts
+    with col_a:
+        st.subheader("🛏️ Availability by Unit Type")
+        st.caption("Which apartment sizes are most common?")
+        if not unit_df.empty:
+            chart_units = alt.Chart(unit_df).mark_bar().encode(
+                x=alt.X('unit_type', sort='-y', title='Unit Type'),
+                y=alt.Y('unit_count', title='Count'),
+                color=alt.value("#9b59b6"),
+                tooltip=[alt.Tooltip('unit_type', title='Unit Type'), alt.Tooltip('unit_count', title='Count')]
+            ).properties(height=300)
+            st.altair_chart(chart_units, use_container_width=True)
         else:
-            df_filtered["monthly_saving"] = 0
-else:
-    df_filtered = pd.DataFrame()
+            st.write("No detailed unit data.")
+
+    # 2. Average Rent by Unit Type (NEW!)
+    with col_b:
+        st.subheader("🏷️ Avg Price by Unit Type")
+        st.caption("Estimated market rent for different apartment sizes.")
+        if not unit_df.empty and unit_df['avg_rent'].notna().any():
+            valid_rent_df = unit_df.dropna(subset=['avg_rent'])
+            avg_rent_chart = alt.Chart(valid_rent_df).mark_bar().encode(
+                x=alt.X('unit_type', sort='-y', title='Unit Type'),
+                y=alt.Y('avg_rent', title='Avg Rent ($)'),
+                color=alt.value("#e67e22"),
+                tooltip=[alt.Tooltip('unit_type', title='Unit Type'), alt.Tooltip('avg_rent', title='Avg Rent', format=",.0f")]
+            ).properties(height=300)
+            st.altair_chart(avg_rent_chart, use_container_width=True)
+        else:
+            st.write("No specific unit rent data available.")
+
+    st.markdown("---")
+    
+    col_c, col_d = st.columns(2)
+
+    # 3. Top Zip Codes (NEW!)
+    with col_c:
+        st.subheader("📍 Hotspot Zip Codes")
+        st.caption("Top 10 Zip Codes with the most matching buildings.")
+        chart_zip = alt.Chart(zip_counts).mark_bar().encode(
+            x=alt.X('n_buildings', title='Buildings'),
+            y=alt.Y('zipcode', sort='-x', title='Zip Code'),
+            color=alt.value("#34495e"),
+            tooltip=[alt.Tooltip('zipcode', title='Zip Code'), alt.Tooltip('n_buildings', title='Count')]
+        ).properties(height=400)
+        st.altair_chart(chart_zip, use_container_width=True)
+
+    # 4. Savings Distribution
+    with col_d:
+        st.subheader("💸 Savings Potential")
+        st.caption("How much under budget are these apartments?")
+        if budget > 0:
+            df_savings = add_monthly_saving(rents_df, budget)
+            chart_hist_savings = alt.Chart(df_savings).mark_bar().encode(
+                x=alt.X('monthly_saving', bin=alt.Bin(maxbins=20), title='Monthly Savings ($)'),
+                y=alt.Y('count()', title='Count'),
+                color=alt.value("#2ecc71"), 
+                tooltip=['count()']
+            ).properties(height=400)
+            st.altair_chart(chart_hist_savings, use_container_width=True)
+        else:
+            st.write("Enter income to see savings analysis.")
+
+@st.fragment
+def render_eligibility_tab(filter_key, monthly_income, rent_ratio_pct, household_size):
+    st.subheader("🎯 Homes You May Qualify For")
+    st.caption(
+        "Unit types whose LL44 income limit and household size fit yours "
+        "(studios: 1–2 people, larger units: 1 per bedroom up to 2 per bedroom + 1). "
+        "The income floor (min_income) is not an LL44 limit: it is an affordability "
+        "estimate, the cheapest rent in the band at your rent burden. "
+        "Each building and unit type shows the cheapest band you qualify for."
+    )
+    if monthly_income <= 0:
+        st.write("Enter income to see matching buildings.")
+        return
+
+    index = fetch_for_tab(get_eligibility_index, rent_ratio_pct)
+    if index is None:
+        return
+    matches = index.match(monthly_income * 12, household_size)
+
+    # Location filters still apply; the rent range does not, eligibility has its own
+    boroughs, _, _, _, zipcode = filter_key
+    if boroughs:
+        matches = matches[matches["borough"].isin(boroughs)]
+    if zipcode:
+        matches = matches[matches["zipcode"] == zipcode]
+
+    col_a, col_b, col_c = st.columns(3)
+    with col_a:
+        st.metric("🏠 Eligible Buildings", f"{matches['building_id'].nunique():,}")
+    with col_b:
+        st.metric("🛏️ Unit Types", f"{len(matches):,}")
+    with col_c:
+        st.metric("🔑 Units", f"{int(matches['units'].sum()):,}")
+
+    if matches.empty:
+        st.info("No unit types match this income and household size.")
+        return
+
+    st.dataframe(
+        matches[[
+            "borough", "address", "zipcode", "bedroom_bucket", "affordability_band",
+            "min_rent", "max_rent", "min_income", "max_income", "units"
+        ]].sort_values("min_rent"),
+        use_container_width=True,
+        height=600
+    )
+
+@st.fragment
+def render_data_tab(filter_key, budget, n_buildings):
+    st.subheader("📋 Detailed Building List")
+
+    # the full export is opt-in per filter set, not re-run on every edit
+    if st.session_state.get("prepare_csv_filter_key") != filter_key:
+        st.session_state["prepare_csv_filter_key"] = filter_key
+        st.session_state["prepare_csv"] = False
+
+    if st.checkbox("Prepare CSV download (all matching buildings)", key="prepare_csv"):
+        csv = fetch_for_tab(get_export_csv, filter_key, budget, channel="export")
+        if csv is not None:
+            st.download_button(
+                label="📥 Download Data as CSV",
+                data=csv,
+                file_name='nyc_housing_filtered.csv',
+                mime='text/csv',
+            )
+
+    n_pages = max(1, -(-n_buildings // TABLE_PAGE_SIZE))
+    if st.session_state.get("table_page", 1) > n_pages:
+        st.session_state["table_page"] = 1
+    page = st.number_input(
+        f"Page (of {n_pages})",
+        min_value=1,
+        max_value=n_pages,
+        step=1,
+        key="table_page"
+    )
+
+    page_df = fetch_for_tab(query_table_page, filter_key, page, TABLE_PAGE_SIZE, channel="table")
+    if page_df is None:
+        return
+    display_df = add_monthly_saving(page_df, budget)
+    display_df = display_df[[
+        "borough", "address", "zipcode", 
+        "min_effective_median_rent", "monthly_saving",
+        "total_ll44_units", "bedroom_rent_summary"
+    ]]
+    
+    st.dataframe(
+        display_df,
+        use_container_width=True,
+        height=600
+    )
 
 # -----------------------------------------------------------------------------
-# 7. Main Dashboard Area
+# 8. Main Dashboard Area
 # -----------------------------------------------------------------------------
 st.title("NYC Affordable Housing Explorer")
 
-if df_filtered.empty:
+kpis = None
+if has_filters:
+    wait_until_done([futures["kpis"]])
+    try:
+        kpis = futures["kpis"].result()
+    except QuerySuperseded:
+        st.stop()
+    except Exception as e:
+        st.error(f"Database connection error: {e}")
+        st.stop()
+
+has_buildings = bool(kpis) and kpis["n_buildings"] > 0
+
+if not has_buildings:
     st.info("👈 Please adjust filters in the sidebar to find buildings.")
     st.write(f"Current Rent Filter: ${min_rent_input} - ${max_rent_input}")
 else:
+    n_buildings = int(kpis["n_buildings"])
     st.markdown(f"""
-        Found **{len(df_filtered):,}** buildings with rent between **\${min_rent_input}** and **\${max_rent_input}**.
+        Found **{n_buildings:,}** buildings with rent between **\${min_rent_input}** and **\${max_rent_input}**.
     """)
 
     # --- Top KPI Cards ---
     kpi1, kpi2, kpi3, kpi4 = st.columns(4)
     with kpi1:
-        st.metric("🏠 Buildings", f"{len(df_filtered):,}")
+        st.metric("🏠 Buildings", f"{n_buildings:,}")
     with kpi2:
-        st.metric("🛏️ Total Units", f"{int(df_filtered['total_ll44_units'].sum()):,}")
+        st.metric("🛏️ Total Units", f"{int(kpis['total_units']):,}")
     with kpi3:
-        avg_rent = df_filtered['min_effective_median_rent'].mean()
-        st.metric("💲 Avg Rent (Filtered)", f"${avg_rent:,.0f}")
+        st.metric("💲 Avg Rent (Filtered)", f"${kpis['avg_rent']:,.0f}")
     with kpi4:
         if calculated_max_rent > 0:
-            max_saving = df_filtered['monthly_saving'].max()
+            max_saving = calculated_max_rent - kpis['min_rent']
             st.metric("💰 Max Potential Savings", f"${max_saving:,.0f}")
         else:
             st.metric("💰 Income Needed", "Enter Income")
 
     st.markdown("---")
 
-    # --- Tabs ---
-    tab_map, tab_analytics, tab_data = st.tabs(["🗺️ Map Explorer", "📈 Market Insights", "📋 Details"])
+# --- Tabs ---
+# Eligibility ignores the rent range, so it stays reachable when the range
+# matches no buildings (the other tabs would be empty then).
+if has_buildings or monthly_income > 0:
+    available_tabs = ALL_TABS if has_buildings else [TAB_ELIGIBILITY]
+    if st.session_state["active_tab"] not in available_tabs:
+        st.session_state["active_tab"] = available_tabs[0]
+
+    # st.tabs would execute every tab body on each rerun; a keyed selector
+    # keeps the choice in session state and renders only the visible one.
+    active_tab = st.radio(
+        "Section",
+        options=available_tabs,
+        key="active_tab",
+        horizontal=True,
+        label_visibility="collapsed"
+    )
 
-    # Downsample for map if needed
-    if len(df_filtered) > max_points:
-        df_plot = df_filtered.sample(n=max_points, random_state=42)
+    # Let the tab's prefetch finish interruptibly. Other errors are retried
+    # (and shown) by the tab itself when it asks for the same data.
+    wait_until_done(futures.values())
+    if any(isinstance(f.exception(), QuerySuperseded) for f in futures.values()):
+        st.stop()
+
+    if active_tab == TAB_MAP:
+        render_map_tab(filter_key, max_points, map_style_toggle, map_layer_type)
+    elif active_tab == TAB_ANALYTICS:
+        render_analytics_tab(filter_key, calculated_max_rent)
+    elif active_tab == TAB_ELIGIBILITY:
+        render_eligibility_tab(filter_key, monthly_income, rent_ratio_pct, household_size)
     else:
-        df_plot = df_filtered
-
-    # --- Tab 1: Map ---
-    with tab_map:
-        view_state = pdk.ViewState(
-            latitude=df_plot["lat"].mean(),
-            longitude=df_plot["lon"].mean(),
-            zoom=10.5,
-            pitch=0, 
-        )
-
-        layers = []
-        tooltip = None
-
-        if map_layer_type == "Scatter":
-            scatter_layer = pdk.Layer(
-                "ScatterplotLayer",
-                data=df_plot,
-                get_position="[lon, lat]",
-                get_radius=30,
-                get_fill_color=[255, 140, 0, 180],
-                get_line_color=[255, 255, 255],
-                pickable=True,
-                auto_highlight=True,
-            )
-            layers.append(scatter_layer)
-            
-            tooltip = {
-                "html": """
-                <div style="color: white; font-family: sans-serif; width: 250px;">
-                    <h4 style="margin: 0; padding-bottom: 5px; border-bottom: 1px solid #555;">{address}</h4>
-                    <div style="margin-top: 5px;">
-                        <strong>Borough:</strong> {borough}<br/>
-                        <strong>Est. Rent:</strong> ${min_effective_median_rent}<br/>
-                        <strong>Units:</strong> {total_ll44_units}
-                    </div>
-                    <div style="margin-top: 10px; font-size: 0.8em; color: #ccc; white-space: pre-wrap;">
-                        {bedroom_rent_summary}
-                    </div>
-                </div>
-                """,
-                "style": {
-                    "backgroundColor": "#1f2937",
-                    "borderRadius": "5px",
-                    "padding": "10px",
-                    "boxShadow": "0 2px 4px rgba(0,0,0,0.3)"
-                }
-            }
-        else:
-            # Heatmap
-            heatmap_layer = pdk.Layer(
-                "HeatmapLayer",
-                data=df_plot,
-                get_position="[lon, lat]",
-                opacity=0.9,
-                get_weight="total_ll44_units",
-                radius_pixels=50,
-            )
-            layers.append(heatmap_layer)
-
-        map_style = "mapbox://styles/mapbox/dark-v10" if map_style_toggle == "Dark" else "mapbox://styles/mapbox/light-v9"
-
-        st.pydeck_chart(pdk.Deck(
-            map_style=map_style,
-            initial_view_state=view_state,
-            layers=layers,
-            tooltip=tooltip,
-        ), use_container_width=True)
-
-    # --- Tab 2: Analytics (Enhanced) ---
-    with tab_analytics:
-        # Parse unit data for advanced charts
-        unit_df = parse_bedroom_data(df_filtered)
-
-        col_a, col_b = st.columns(2)
-        
-        # 1. Unit Type Counts
-        with col_a:
-            st.subheader("🛏️ Availability by Unit Type")
-            st.caption("Which apartment sizes are most common?")
-            if not unit_df.empty:
-                unit_counts = unit_df.groupby('Unit Type')['Count'].sum().reset_index()
-                chart_units = alt.Chart(unit_counts).mark_bar().encode(
-                    x=alt.X('Unit Type', sort='-y'),
-                    y='Count',
-                    color=alt.value("#9b59b6"),
-                    tooltip=['Unit Type', 'Count']
-                ).properties(height=300)
-                st.altair_chart(chart_units, use_container_width=True)
-            else:
-                st.write("No detailed unit data.")
-
-        # 2. Average Rent by Unit Type (NEW!)
-        with col_b:
-            st.subheader("🏷️ Avg Price by Unit Type")
-            st.caption("Estimated market rent for different apartment sizes.")
-            if not unit_df.empty and unit_df['Est Rent'].notna().any():
-                # Filter out rows where rent is None or 0 for this chart
-                valid_rent_df = unit_df[unit_df['Est Rent'] > 0]
-                if not valid_rent_df.empty:
-                    avg_rent_chart = alt.Chart(valid_rent_df).mark_bar().encode(
-                        x=alt.X('Unit Type', sort='-y'),
-                        y=alt.Y('mean(Est Rent)', title='Avg Rent ($)'),
-                        color=alt.value("#e67e22"),
-                        tooltip=['Unit Type', alt.Tooltip('mean(Est Rent)', format=",.0f")]
-                    ).properties(height=300)
-                    st.altair_chart(avg_rent_chart, use_container_width=True)
-                else:
-                    st.info("Rent details per unit type are not available in current selection.")
-            else:
-                st.write("No specific unit rent data available.")
-
-        st.markdown("---")
-        
-        col_c, col_d = st.columns(2)
-
-        # 3. Top Zip Codes (NEW!)
-        with col_c:
-            st.subheader("📍 Hotspot Zip Codes")
-            st.caption("Top 10 Zip Codes with the most matching buildings.")
-            zip_counts = df_filtered['zipcode'].value_counts().reset_index()
-            zip_counts.columns = ['Zip Code', 'Count']
-            chart_zip = alt.Chart(zip_counts.head(10)).mark_bar().encode(
-                x=alt.X('Count', title='Buildings'),
-                y=alt.Y('Zip Code', sort='-x'),
-                color=alt.value("#34495e"),
-                tooltip=['Zip Code', 'Count']
-            ).properties(height=400)
-            st.altair_chart(chart_zip, use_container_width=True)
-
-        # 4. Savings Distribution
-        with col_d:
-            st.subheader("💸 Savings Potential")
-            st.caption("How much under budget are these apartments?")
-            if calculated_max_rent > 0:
-                chart_hist_savings = alt.Chart(df_filtered).mark_bar().encode(
-                    x=alt.X('monthly_saving', bin=alt.Bin(maxbins=20), title='Monthly Savings ($)'),
-                    y=alt.Y('count()', title='Count'),
-                    color=alt.value("#2ecc71"), 
-                    tooltip=['count()']
-                ).properties(height=400)
-                st.altair_chart(chart_hist_savings, use_container_width=True)
-            else:
-                st.write("Enter income to see savings analysis.")
-
-    # --- Tab 3: Data Table ---
-    with tab_data:
-        st.subheader("📋 Detailed Building List")
-        
-        csv = df_filtered.to_csv(index=False).encode('utf-8')
-        st.download_button(
-            label="📥 Download Data as CSV",
-            data=csv,
-            file_name='nyc_housing_filtered.csv',
-            mime='text/csv',
-        )
-        
-        display_df = df_filtered[[
-            "borough", "address", "zipcode", 
-            "min_effective_median_rent", "monthly_saving",
-            "total_ll44_units", "bedroom_rent_summary"
-        ]].sort_values("min_effective_median_rent", ascending=True)
-        
-        st.dataframe(
-            display_df,
-            use_container_width=True,
-            height=600
-        )
\ No newline at end of file
+        render_data_tab(filter_key, calculated_max_rent, n_buildings)